@@ -1,6 +1,7 @@
 from __future__ import division
 
 import os
+import time
 import unittest
 import tempfile
 import subprocess
@@ -10,6 +11,7 @@ from zipfile import ZipFile
 from shutil import rmtree
 
 from httmock import HTTMock, response
+from requests.exceptions import HTTPError
 
 from .. import preview
 
@@ -17,16 +19,17 @@ class TestPreview (unittest.TestCase):
 
     def setUp(self):
         self.temp_dir = tempfile.mkdtemp(prefix='TestPreview-')
+        self.prev_cache_dir = preview.TILE_CACHE_DIR
+        preview.TILE_CACHE_DIR = join(self.temp_dir, 'tiles')
 
     def tearDown(self):
+        preview.TILE_CACHE_DIR = self.prev_cache_dir
         rmtree(self.temp_dir)
 
     def test_stats(self):
         points = [(n, n) for n in range(-1000, 1001)]
-        points_filename = join(self.temp_dir, 'points.bin')
-        preview.write_points(points, points_filename)
 
-        xmean, xsdev, ymean, ysdev = preview.stats(points_filename)
+        xmean, xsdev, ymean, ysdev = preview.stats(points)
         self.assertAlmostEqual(xmean, 0)
         self.assertAlmostEqual(xsdev, 577.783263863)
         self.assertAlmostEqual(ymean, xmean)
@@ -35,11 +38,9 @@ class TestPreview (unittest.TestCase):
     def test_calculate_bounds(self):
         points = [(-10000, -10000), (10000, 10000)]
         points += [(-1, -1), (0, 0), (1, 1)] * 100
-        points_filename = join(self.temp_dir, 'points.bin')
-        preview.write_points(points, points_filename)
 
-        bbox = preview.calculate_bounds(points_filename)
-        self.assertEqual(bbox, (-1.04, -1.04, 1.04, 1.04), 'The two outliers are ignored')
+        bbox = preview.calculate_bounds(points)
+        self.assertEqual(tuple(bbox), (-1.04, -1.04, 1.04, 1.04), 'The two outliers are ignored')
 
     def test_render_zip(self):
         '''
@@ -121,8 +122,65 @@ class TestPreview (unittest.TestCase):
             landuse_geoms, water_geoms, roads_geoms = \
                 preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX')
 
-        self.assertEqual(len(landuse_geoms), 90, 'Should have 90 landuse geometries')
-        self.assertEqual(len(water_geoms), 1, 'Should have 1 water geometry')
-        self.assertEqual(len(roads_geoms), 792, 'Should have 792 road geometries')
+        self.assertEqual(len(landuse_geoms), 11, 'Should have 11 landuse geometries in view')
+        self.assertEqual(len(water_geoms), 1, 'Should have 1 water geometry in view')
+        self.assertEqual(len(roads_geoms), 139, 'Should have 139 road geometries in view')
+
+    def test_tile_cache(self):
+        '''
+        '''
+        counts = dict(requests=0)
+
+        def response_content(url, request):
+            if url.hostname == 'a.tiles.mapbox.com' and url.path.startswith('/v4/mapbox.mapbox-streets-v7'):
+                counts['requests'] += 1
+                with open(join(dirname(__file__), 'data', 'mapbox-tile.mvt'), 'rb') as file:
+                    data = file.read()
+                return response(200, data, headers={'Content-Type': 'application/vnd.mapbox-vector-tile'})
+            raise Exception("Uknown URL")
+
+        xmin, ymin, xmax, ymax = -13611952, 4551290, -13609564, 4553048
+        scale = 100 / (xmax - xmin)
+
+        with HTTMock(response_content):
+            geoms1 = preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX')
+            self.assertEqual(counts['requests'], 1, 'Should have downloaded one tile')
+
+            geoms2 = preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX')
+            self.assertEqual(counts['requests'], 1, 'Second call should be served from the tile cache')
+
+            for name in os.listdir(preview.TILE_CACHE_DIR):
+                stale = time.time() - preview.TILE_CACHE_LIFESPAN - 1
+                os.utime(join(preview.TILE_CACHE_DIR, name), (stale, stale))
+
+            preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX')
+            self.assertEqual(counts['requests'], 2, 'Stale tile should be downloaded again')
+
+        for (geom1, geom2) in zip(geoms1, geoms2):
+            self.assertEqual(len(geom1), len(geom2), 'Cached tile should give the same geometries')
+
+    def test_tile_cache_error(self):
+        '''
+        '''
+        status = dict(code=500)
+
+        def response_content(url, request):
+            if url.hostname == 'a.tiles.mapbox.com' and url.path.startswith('/v4/mapbox.mapbox-streets-v7'):
+                with open(join(dirname(__file__), 'data', 'mapbox-tile.mvt'), 'rb') as file:
+                    data = file.read()
+                return response(status['code'], data, headers={'Content-Type': 'application/vnd.mapbox-vector-tile'})
+            raise Exception("Uknown URL")
+
+        xmin, ymin, xmax, ymax = -13611952, 4551290, -13609564, 4553048
+        scale = 100 / (xmax - xmin)
+
+        with HTTMock(response_content):
+            with self.assertRaises(HTTPError):
+                preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX')
+
+            status['code'] = 200
+            _, water_geoms, _ = preview.get_map_features(xmin, ymin, xmax, ymax, 2, scale, 'mapbox-XXXX')
+
+        self.assertEqual(len(water_geoms), 1, 'Error response should not have been cached')
 
 
@@ -73,6 +73,12 @@ setup(
         # http://initd.org/psycopg/
         'psycopg2-binary == 2.8.4',
 
+        # https://numpy.org
+        'numpy == 1.18.1',
+
+        # https://pandas.pydata.org
+        'pandas == 0.25.3',
+
         # http://docs.python-requests.org/en/master/
         'requests == 2.22.0',
 